@@ -1,36 +1,139 @@
-from fastapi import FastAPI, HTTPException, Header
+from contextlib import asynccontextmanager
+from datetime import date, datetime
+from fastapi import FastAPI, HTTPException, Header, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, List
-from supabase import create_client, Client
+from pydantic import BaseModel, ConfigDict, ValidationError, field_validator
+from typing import Optional, List, Literal
+from supabase import acreate_client, AsyncClient, AsyncClientOptions, AuthApiError, AuthError, PostgrestAPIError
+from cachetools import TLRUCache, TTLCache
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+import asyncio
+import hashlib
+import httpx
+import jwt
 import os
+import time
 
-# Initialize Supabase clients
+# Supabase settings
 url = os.environ.get("SUPABASE_URL")
 anon_key = os.environ.get("SUPABASE_KEY")  # For auth verification
 service_role_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")  # For DB operations
+jwt_secret = os.environ.get("SUPABASE_JWT_SECRET")  # For local token verification
+redis_url = os.environ.get("REDIS_URL")  # Optional auth cache shared by all workers
 
-# Client for auth verification (anon key)
-if url and anon_key:
-    supabase: Client = create_client(url, anon_key)
-else:
-    supabase = None
+# Browser origins allowed to call the API: the frontend, any extra ones (comma separated),
+# plus an optional regex
+cors_origins = tuple(
+    origin.strip()
+    for origin in (os.environ.get("FRONTEND_URL", ""), *os.environ.get("CORS_ALLOWED_ORIGINS", "").split(","))
+    if origin.strip()
+)
+cors_origin_regex = os.environ.get("CORS_ALLOWED_ORIGIN_REGEX")
+
+# Upper bound on how long a token verified by Supabase Auth is trusted without re-checking
+AUTH_CACHE_TTL = 60
+# How long a token rejected by Supabase Auth is answered with 401 without re-checking
+REJECTED_TOKEN_TTL = 5
+# How long /auth/me serves a profile from memory
+PROFILE_CACHE_TTL = 30
+
+# Prefix of the Authorization header value
+_BEARER = "Bearer "
+
+# Columns of 'users' exposed through UserProfile
+USER_PROFILE_COLUMNS = "id,email,full_name,avatar_url,phone,role"
+
+# ===== SUPABASE CLIENTS =====
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Create the Supabase clients on startup and close their connection pool on shutdown.
+    Clients live on app.state: 'supabase' (anon key, auth verification) and
+    'supabase_admin' (service role key, DB operations - bypasses RLS).
+    """
+    # Each path/method pair must be handled exactly once
+    routes = [(route.path, frozenset(getattr(route, "methods", None) or ())) for route in app.routes]
+    if len(set(routes)) != len(routes):
+        raise RuntimeError("Duplicate route registration")
+
+    # One pooled HTTP/2 client shared by both Supabase clients
+    http_client = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        timeout=httpx.Timeout(10.0, connect=2.0)
+    )
 
-# Admin client for DB operations (service role key - bypasses RLS)
-if url and service_role_key:
-    supabase_admin: Client = create_client(url, service_role_key)
-elif url and anon_key:
-    # Fallback to anon key if service role not set
-    supabase_admin = supabase
-else:
-    supabase_admin = None
+    app.state.supabase = None
+    app.state.supabase_admin = None
+    # Short timeouts so an unreachable Redis falls back to Supabase Auth instead of hanging
+    app.state.redis = aioredis.from_url(
+        redis_url, socket_connect_timeout=0.2, socket_timeout=0.2
+    ) if redis_url else None
+
+    if url and anon_key:
+        app.state.supabase = await acreate_client(
+            url, anon_key, options=AsyncClientOptions(httpx_client=http_client)
+        )
+
+    if url and service_role_key:
+        app.state.supabase_admin = await acreate_client(
+            url, service_role_key, options=AsyncClientOptions(httpx_client=http_client)
+        )
+    elif url and anon_key:
+        # Fallback to anon key if service role not set
+        app.state.supabase_admin = app.state.supabase
+
+    # Static for the life of the process, so /health serves it pre-rendered
+    app.state.health_body = HealthStatus(
+        status="ok",
+        supabase_connected=app.state.supabase is not None,
+        service_role_enabled=app.state.supabase_admin is not app.state.supabase
+    ).model_dump_json().encode()
+
+    yield
+
+    await http_client.aclose()
+    if app.state.redis is not None:
+        await app.state.redis.aclose()
+
+
+async def _with_retry(call, *args):
+    """
+    Run a read-only Supabase call, retrying once if the server dropped the pooled
+    connection it was sent on. Writes are never retried.
+    """
+    try:
+        return await call(*args)
+    except httpx.RemoteProtocolError:
+        return await call(*args)
+
+
+async def get_supabase(request: Request) -> AsyncClient:
+    """Anon client, used to verify user tokens."""
+    if not request.app.state.supabase:
+        raise HTTPException(status_code=500, detail="Supabase not configured")
+    return request.app.state.supabase
+
+
+async def get_supabase_admin(request: Request) -> AsyncClient:
+    """Service role client, used for DB operations."""
+    if not request.app.state.supabase_admin:
+        raise HTTPException(status_code=500, detail="Supabase not configured")
+    return request.app.state.supabase_admin
+
+
+async def get_redis(request: Request) -> Optional[aioredis.Redis]:
+    """Shared cache client, or None when REDIS_URL isn't set."""
+    return request.app.state.redis
 
 
 # ===== MODELS =====
 
 class CompleteProfileRequest(BaseModel):
     full_name: str
-    role: str
+    role: Literal["elderly", "family_supervisor", "professional"]
     phone: Optional[str] = None
 
 
@@ -41,6 +144,7 @@ class CompleteProfessionalRequest(BaseModel):
     professional_email: str
     specialization: str
     workplace: Optional[str] = None
+    avatar_url: Optional[str] = None  # Defaults to the OAuth provider's picture
 
 
 class CompleteCaregiverRequest(BaseModel):
@@ -48,17 +152,28 @@ class CompleteCaregiverRequest(BaseModel):
     full_name: str
     patient_phone: str
     caregiver_phone: str
-    date_of_birth: str  # DD/MM/YYYY format
-    gender: str  # male, female, other
+    date_of_birth: date  # Sent as DD/MM/YYYY
+    gender: Literal["male", "female", "other"]
     height_cm: int
     weight_kg: float
     address: str
     allergies: List[str] = []
     conditions: List[str] = []
     medications: List[str] = []
+    avatar_url: Optional[str] = None  # Defaults to the OAuth provider's picture
+
+    @field_validator("date_of_birth", mode="before")
+    @classmethod
+    def parse_date_of_birth(cls, value):
+        """Parse DD/MM/YYYY; anything else is left to Pydantic's ISO date parsing."""
+        if isinstance(value, str) and "/" in value:
+            return datetime.strptime(value, "%d/%m/%Y").date()
+        return value
 
 
 class UserProfile(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     id: str
     email: str
     full_name: str
@@ -67,298 +182,454 @@ class UserProfile(BaseModel):
     role: str
 
 
+class AuthUser(BaseModel):
+    """Authenticated caller, from verified token claims or Supabase Auth."""
+    id: str
+    email: Optional[str] = None
+    user_metadata: dict = {}
+
+
+class MessageResponse(BaseModel):
+    message: str
+
+
+class HealthStatus(BaseModel):
+    status: str
+    supabase_connected: bool
+    service_role_enabled: bool
+
+
+class ReadinessStatus(BaseModel):
+    status: str
+
+
+# ===== AUTH HELPERS =====
+
+async def bearer_token(authorization: str = Header(...)) -> str:
+    """Extract the access token from an 'Authorization: Bearer <token>' header."""
+    if len(authorization) < 8 or authorization[:7] != _BEARER:
+        raise HTTPException(status_code=401, detail="Invalid authorization header")
+    return authorization[7:]
+
+
+async def _decode_token(supabase: AsyncClient, token: str) -> Optional[dict]:
+    """
+    Verify a Supabase access token without a Supabase Auth round trip: HS256 tokens
+    against the project JWT secret, asymmetric ones against the project's JWKS
+    (fetched and cached by the auth client).
+    Returns the token claims, or None if the token can't be verified here.
+    """
+    # Tokens Supabase Auth already settled never reach the JWKS lookup, which refetches on
+    # unknown kids; _get_user answers them from its caches
+    key = _token_key(token)
+    if key in _auth_cache or key in _rejected_tokens:
+        return None
+    try:
+        header = jwt.get_unverified_header(token)
+        if header.get("alg") == "HS256":
+            if not jwt_secret:
+                return None
+            return jwt.decode(
+                token, jwt_secret, algorithms=["HS256"], audience="authenticated",
+                options={"require": ["exp", "sub"]}
+            )
+        if "kid" not in header:
+            return None
+        claims = (await supabase.auth.get_claims(token))["claims"]
+    except (jwt.PyJWTError, AuthError, ValueError):
+        # Includes headers the auth client's own JWT models reject (pydantic ValidationError)
+        return None
+    
+    if claims.get("aud") != "authenticated" or "exp" not in claims or "sub" not in claims:
+        return None
+    return claims
+
+
+def _avatar(metadata: dict) -> Optional[str]:
+    """Avatar URL from Supabase user metadata (key depends on the OAuth provider)."""
+    return metadata.get("avatar_url") or metadata.get("picture")
+
+
+def _auth_cache_ttu(token: str, entry: tuple, now: float) -> float:
+    """Cached users expire with their token, but never later than AUTH_CACHE_TTL from now."""
+    return min(entry[1], now + AUTH_CACHE_TTL)
+
+
+# In-process caches, keyed by token hash or user id. Only touched from the event loop, so no lock.
+_auth_cache = TLRUCache(maxsize=10_000, ttu=_auth_cache_ttu, timer=time.time)
+_rejected_tokens = TTLCache(maxsize=10_000, ttl=REJECTED_TOKEN_TTL)
+_profile_cache = TTLCache(maxsize=10_000, ttl=PROFILE_CACHE_TTL)
+
+
+def _token_key(token: str) -> str:
+    """Cache key for a token, so raw tokens are never kept in memory."""
+    return hashlib.sha256(token.encode()).hexdigest()[:32]
+
+
+def _token_exp(token: str) -> float:
+    """Expiry of a token whose signature was already checked elsewhere (0 if unknown)."""
+    try:
+        return jwt.decode(token, options={"verify_signature": False}).get("exp", 0)
+    except jwt.InvalidTokenError:
+        return 0
+
+
+def _token_sub(token: str) -> Optional[str]:
+    """Subject a token claims to be for, unverified. Only a hint until the token is checked."""
+    try:
+        return jwt.decode(token, options={"verify_signature": False}).get("sub")
+    except jwt.InvalidTokenError:
+        return None
+
+
+async def _shared_cache_get(redis: Optional[aioredis.Redis], key: str) -> Optional[AuthUser]:
+    """Look up a verified user in Redis. Redis errors and unreadable entries count as a miss."""
+    if redis is None:
+        return None
+    try:
+        cached = await redis.get(f"carenet:auth:{key}")
+        return AuthUser.model_validate_json(cached) if cached else None
+    except (RedisError, ValidationError):
+        return None
+
+
+async def _shared_cache_set(redis: Optional[aioredis.Redis], key: str, user: AuthUser, exp: float):
+    """Store a verified user in Redis until its token expires (at most AUTH_CACHE_TTL)."""
+    ttl = int(min(AUTH_CACHE_TTL, exp - time.time()))
+    if redis is None or ttl <= 0:
+        return
+    try:
+        await redis.set(f"carenet:auth:{key}", user.model_dump_json(), ex=ttl)
+    except RedisError:
+        pass
+
+
+async def _get_user(
+    supabase: AsyncClient, token: str, redis: Optional[aioredis.Redis] = None
+) -> Optional[AuthUser]:
+    """
+    Verify a token with Supabase Auth, reusing the result until the token expires.
+    Checks the in-process cache, then Redis (if configured), then Supabase Auth.
+    Returns None if the token is rejected.
+    """
+    key = _token_key(token)
+    cached = _auth_cache.get(key)
+    if cached:
+        return cached[0]
+    if key in _rejected_tokens:
+        return None
+    
+    exp = _token_exp(token)
+    user = await _shared_cache_get(redis, key)
+    if not user:
+        try:
+            response = await _with_retry(supabase.auth.get_user, token)
+        except AuthApiError as e:
+            # Only a rejected token (malformed, invalid or expired) is cached as such;
+            # rate limiting and other errors are Supabase Auth failing, not the token
+            if e.status not in (400, 401, 403):
+                raise
+            response = None
+        if not response or not response.user:
+            _rejected_tokens[key] = True
+            return None
+        
+        user = AuthUser.model_construct(
+            id=response.user.id,
+            email=response.user.email,
+            user_metadata=response.user.user_metadata or {}
+        )
+        await _shared_cache_set(redis, key, user, exp)
+    
+    _auth_cache[key] = (user, exp)
+    return user
+
+
+async def _authenticate(
+    supabase: AsyncClient, token: str, redis: Optional[aioredis.Redis] = None
+) -> Optional[AuthUser]:
+    """Identify the caller from locally verified token claims, falling back to Supabase Auth."""
+    claims = await _decode_token(supabase, token)
+    if claims:
+        # Verified claims need no re-validation
+        return AuthUser.model_construct(
+            id=claims["sub"],
+            email=claims.get("email"),
+            user_metadata=claims.get("user_metadata") or {}
+        )
+    return await _get_user(supabase, token, redis)
+
+
+async def current_user(
+    token: str = Depends(bearer_token),
+    supabase: AsyncClient = Depends(get_supabase),
+    redis: Optional[aioredis.Redis] = Depends(get_redis)
+) -> AuthUser:
+    """Authenticated caller. Their profile may not have been completed yet."""
+    try:
+        user = await _authenticate(supabase, token, redis)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return user
+
+
+async def _register(query) -> UserProfile:
+    """
+    Execute a registration write and return the created profile.
+    The write returns no row, or fails with unique_violation, if the profile already exists.
+    """
+    try:
+        result = await query.execute()
+    except PostgrestAPIError as e:
+        if e.code == "23505":  # unique_violation
+            raise HTTPException(status_code=400, detail="Profile already exists")
+        raise HTTPException(status_code=500, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    if not result.data:
+        raise HTTPException(status_code=400, detail="Profile already exists")
+    created = result.data[0] if isinstance(result.data, list) else result.data
+    profile = UserProfile.model_validate(created)
+    _profile_cache[profile.id] = profile
+    return profile
+
+
 # ===== APP =====
 
-app = FastAPI(title="CareNet API", version="1.0.0")
+class HealthCheckMiddleware:
+    """
+    Answer GET /health before CORS, exception handling and routing run.
+    The response body is rendered once in lifespan (app.state.health_body).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != "/health" or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+        
+        body = scope["app"].state.health_body
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", b"%d" % len(body))]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+app = FastAPI(title="CareNet API", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=cors_origins,
+    allow_origin_regex=cors_origin_regex,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=("GET", "POST"),
+    allow_headers=("Authorization", "Content-Type"),
+    max_age=86400,  # let browsers reuse a preflight for a day
 )
+# Added last so it wraps every other middleware
+app.add_middleware(HealthCheckMiddleware)
 
 
-@app.get("/")
-def read_root():
+@app.get("/", response_model=MessageResponse)
+async def read_root():
     return {"message": "Hello from CareNet API"}
 
 
-@app.get("/health")
-def health_check():
-    return {
-        "status": "ok", 
-        "supabase_connected": supabase is not None,
-        "service_role_enabled": supabase_admin is not supabase
-    }
+@app.get("/health/ready", response_model=ReadinessStatus)
+async def readiness_check(supabase_admin: AsyncClient = Depends(get_supabase_admin)):
+    """Check that the database is reachable through the pooled connection."""
+    try:
+        await _with_retry(supabase_admin.table("users").select("id", head=True).limit(1).execute)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {"status": "ok"}
 
 
 # ===== AUTH PROFILE ENDPOINTS =====
 
 @app.post("/auth/complete-profile", response_model=UserProfile)
-def complete_profile(profile_data: CompleteProfileRequest, authorization: str = Header(...)):
+async def complete_profile(
+    profile_data: CompleteProfileRequest,
+    user: AuthUser = Depends(current_user),
+    supabase_admin: AsyncClient = Depends(get_supabase_admin)
+):
     """
     Complete user profile after first login.
     Uses anon key to verify user token, then service_role key to insert (bypasses RLS).
     """
-    if not supabase or not supabase_admin:
-        raise HTTPException(status_code=500, detail="Supabase not configured")
-    
-    valid_roles = ['elderly', 'family_supervisor', 'professional']
-    if profile_data.role not in valid_roles:
-        raise HTTPException(status_code=400, detail=f"Invalid role. Must be one of: {valid_roles}")
-    
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid authorization header")
+    new_user = {
+        "id": user.id,
+        "email": user.email,
+        "full_name": profile_data.full_name,
+        "avatar_url": _avatar(user.user_metadata),
+        "phone": profile_data.phone,
+        "role": profile_data.role
+    }
     
-    token = authorization.replace("Bearer ", "")
+    # An existing row is left untouched and nothing is returned
+    return await _register(
+        supabase_admin.table("users")
+        .upsert(new_user, on_conflict="id", ignore_duplicates=True)
+        .select(USER_PROFILE_COLUMNS)
+    )
+
+
+async def _load_profile(supabase_admin: AsyncClient, user_id: str, cache: bool = True) -> UserProfile:
+    """
+    Profile for a user id, from the process cache or the database (404 if there is none).
+    Pass cache=False for a user id that isn't verified yet, so the row isn't cached for it.
+    """
+    profile = _profile_cache.get(user_id)
+    if profile:
+        return profile
     
     try:
-        # 1. Verify user token with anon key
-        user_response = supabase.auth.get_user(token)
-        user = user_response.user
-        if not user:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        # 2. Check if profile already exists (using admin to bypass RLS)
-        existing = supabase_admin.table("users").select("*").eq("id", user.id).execute()
-        if existing.data and len(existing.data) > 0:
-            raise HTTPException(status_code=400, detail="Profile already exists")
-        
-        # 3. Prepare new user data
-        metadata = user.user_metadata or {}
-        new_user = {
-            "id": user.id,
-            "email": user.email,
-            "full_name": profile_data.full_name,
-            "avatar_url": metadata.get("avatar_url") or metadata.get("picture"),
-            "phone": profile_data.phone,
-            "role": profile_data.role
-        }
-        
-        # 4. Insert using service_role key (bypasses RLS)
-        result = supabase_admin.table("users").insert(new_user).execute()
-        
-        if not result.data:
-            raise HTTPException(status_code=500, detail="Failed to create profile")
-        
-        created = result.data[0]
-        return UserProfile(
-            id=created["id"],
-            email=created["email"],
-            full_name=created["full_name"],
-            avatar_url=created.get("avatar_url"),
-            phone=created.get("phone"),
-            role=created["role"]
+        # Get profile using admin client, as a single object rather than a list
+        result = await _with_retry(
+            supabase_admin.table("users").select(USER_PROFILE_COLUMNS).eq("id", user_id).single().execute
         )
-    except HTTPException:
-        raise
+        profile = UserProfile.model_validate(result.data)
+    except PostgrestAPIError as e:
+        if e.code == "PGRST116":  # no rows
+            raise HTTPException(status_code=404, detail="Profile not found")
+        raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    
+    if cache:
+        _profile_cache[user_id] = profile
+    return profile
 
 
 @app.get("/auth/me", response_model=UserProfile)
-def get_me(authorization: str = Header(...)):
-    """Get current authenticated user's profile."""
-    if not supabase or not supabase_admin:
-        raise HTTPException(status_code=500, detail="Supabase not configured")
-    
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid authorization header")
-    
-    token = authorization.replace("Bearer ", "")
-    
+async def get_me(
+    token: str = Depends(bearer_token),
+    supabase: AsyncClient = Depends(get_supabase),
+    supabase_admin: AsyncClient = Depends(get_supabase_admin),
+    redis: Optional[aioredis.Redis] = Depends(get_redis)
+):
+    """
+    Get current authenticated user's profile.
+    If the token has to be checked with Supabase Auth, the profile it claims is fetched
+    meanwhile and only returned once the token is verified for that same user.
+    """
     try:
-        # Verify user token
-        user_response = supabase.auth.get_user(token)
-        user = user_response.user
-        if not user:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        # Get profile using admin client
-        result = supabase_admin.table("users").select("*").eq("id", user.id).execute()
-        if not result.data or len(result.data) == 0:
-            raise HTTPException(status_code=404, detail="Profile not found")
-        
-        profile = result.data[0]
-        return UserProfile(
-            id=profile["id"],
-            email=profile["email"],
-            full_name=profile["full_name"],
-            avatar_url=profile.get("avatar_url"),
-            phone=profile.get("phone"),
-            role=profile["role"]
-        )
-    except HTTPException:
-        raise
+        claims = await _decode_token(supabase, token)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    if claims:
+        return await _load_profile(supabase_admin, claims["sub"])
+    
+    # Overlap only a real Supabase Auth round trip; known tokens are answered from cache,
+    # and rejected ones must not cost a DB query for a sub the caller picked
+    key = _token_key(token)
+    claimed_id = _token_sub(token)
+    lookups = [_get_user(supabase, token, redis)]
+    if claimed_id and key not in _auth_cache and key not in _rejected_tokens:
+        lookups.append(_load_profile(supabase_admin, claimed_id, cache=False))
+    
+    user, *speculative = await asyncio.gather(*lookups, return_exceptions=True)
+    if isinstance(user, BaseException):
+        raise HTTPException(status_code=500, detail=str(user))
+    if not user:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    if not speculative or user.id != claimed_id:
+        return await _load_profile(supabase_admin, user.id)
+    profile = speculative[0]
+    if isinstance(profile, BaseException):
+        raise profile
+    _profile_cache[user.id] = profile
+    return profile
 
 
 @app.post("/auth/complete-professional", response_model=UserProfile)
-def complete_professional(data: CompleteProfessionalRequest, authorization: str = Header(...)):
+async def complete_professional(
+    data: CompleteProfessionalRequest,
+    user: AuthUser = Depends(current_user),
+    supabase_admin: AsyncClient = Depends(get_supabase_admin)
+):
     """
     Complete professional registration.
     Creates user in 'users' table + professional profile in 'professional_profiles' table.
     """
-    if not supabase or not supabase_admin:
-        raise HTTPException(status_code=500, detail="Supabase not configured")
-    
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid authorization header")
-    
-    token = authorization.replace("Bearer ", "")
+    new_user = {
+        "id": user.id,
+        "email": user.email,
+        "full_name": data.full_name,
+        "avatar_url": data.avatar_url or _avatar(user.user_metadata),
+        "phone": data.phone,
+        "role": "professional"
+    }
+    professional_profile = {
+        "user_id": user.id,
+        "professional_email": data.professional_email,
+        "specialization": data.specialization,
+        "workplace": data.workplace or None
+    }
     
-    try:
-        # 1. Verify user token
-        user_response = supabase.auth.get_user(token)
-        user = user_response.user
-        if not user:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        # 2. Check if profile already exists
-        existing = supabase_admin.table("users").select("*").eq("id", user.id).execute()
-        if existing.data and len(existing.data) > 0:
-            raise HTTPException(status_code=400, detail="Profile already exists")
-        
-        # 3. Insert user
-        metadata = user.user_metadata or {}
-        new_user = {
-            "id": user.id,
-            "email": user.email,
-            "full_name": data.full_name,
-            "avatar_url": metadata.get("avatar_url") or metadata.get("picture"),
-            "phone": data.phone,
-            "role": "professional"
-        }
-        user_result = supabase_admin.table("users").insert(new_user).execute()
-        if not user_result.data:
-            raise HTTPException(status_code=500, detail="Failed to create user profile")
-        
-        # 4. Insert professional profile
-        professional_profile = {
-            "user_id": user.id,
-            "professional_email": data.professional_email,
-            "specialization": data.specialization,
-            "workplace": data.workplace or None
-        }
-        prof_result = supabase_admin.table("professional_profiles").insert(professional_profile).execute()
-        if not prof_result.data:
-            raise HTTPException(status_code=500, detail="Failed to create professional profile")
-        
-        created = user_result.data[0]
-        return UserProfile(
-            id=created["id"],
-            email=created["email"],
-            full_name=created["full_name"],
-            avatar_url=created.get("avatar_url"),
-            phone=created.get("phone"),
-            role=created["role"]
-        )
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Insert both in one transaction (see supabase/migrations)
+    return await _register(
+        supabase_admin.rpc("create_professional", {
+            "_user": new_user,
+            "_prof": professional_profile
+        }).select(USER_PROFILE_COLUMNS)
+    )
 
 
 @app.post("/auth/complete-caregiver", response_model=UserProfile)
-def complete_caregiver(data: CompleteCaregiverRequest, authorization: str = Header(...)):
+async def complete_caregiver(
+    data: CompleteCaregiverRequest,
+    user: AuthUser = Depends(current_user),
+    supabase_admin: AsyncClient = Depends(get_supabase_admin)
+):
     """
     Complete caregiver registration.
     Creates user in 'users' table + elderly profile in 'elderly_profiles' table + medical info.
     """
-    if not supabase or not supabase_admin:
-        raise HTTPException(status_code=500, detail="Supabase not configured")
-    
-    if not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Invalid authorization header")
-    
-    token = authorization.replace("Bearer ", "")
-    
-    try:
-        # 1. Verify user token
-        user_response = supabase.auth.get_user(token)
-        user = user_response.user
-        if not user:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        # 2. Check if profile already exists
-        existing = supabase_admin.table("users").select("*").eq("id", user.id).execute()
-        if existing.data and len(existing.data) > 0:
-            raise HTTPException(status_code=400, detail="Profile already exists")
-        
-        # 3. Convert date from DD/MM/YYYY to YYYY-MM-DD
-        date_parts = data.date_of_birth.split("/")
-        if len(date_parts) == 3:
-            date_of_birth_iso = f"{date_parts[2]}-{date_parts[1]}-{date_parts[0]}"
-        else:
-            date_of_birth_iso = data.date_of_birth  # Fallback, assume already ISO
-        
-        # 4. Insert user
-        metadata = user.user_metadata or {}
-        new_user = {
-            "id": user.id,
-            "email": user.email,
-            "full_name": data.full_name,
-            "avatar_url": metadata.get("avatar_url") or metadata.get("picture"),
-            "phone": data.patient_phone,
-            "role": "family_supervisor",
-            "emergency_contact": data.caregiver_phone
-        }
-        user_result = supabase_admin.table("users").insert(new_user).execute()
-        if not user_result.data:
-            raise HTTPException(status_code=500, detail="Failed to create user profile")
-        
-        # 5. Insert elderly profile
-        elderly_profile = {
-            "user_id": user.id,
-            "date_of_birth": date_of_birth_iso,
-            "gender": data.gender,
-            "height_cm": data.height_cm,
-            "weight_kg": data.weight_kg,
-            "home_address": data.address
+    new_user = {
+        "id": user.id,
+        "email": user.email,
+        "full_name": data.full_name,
+        "avatar_url": data.avatar_url or _avatar(user.user_metadata),
+        "phone": data.patient_phone,
+        "role": "family_supervisor",
+        "emergency_contact": data.caregiver_phone
+    }
+    elderly_profile = {
+        "user_id": user.id,
+        "date_of_birth": data.date_of_birth.isoformat(),
+        "gender": data.gender,
+        "height_cm": data.height_cm,
+        "weight_kg": data.weight_kg,
+        "home_address": data.address
+    }
+    medical_rows = [
+        {
+            "elderly_id": user.id,
+            "info_type": info_type,
+            "name": name,
+            "added_by": user.id
         }
-        elderly_result = supabase_admin.table("elderly_profiles").insert(elderly_profile).execute()
-        if not elderly_result.data:
-            raise HTTPException(status_code=500, detail="Failed to create elderly profile")
-        
-        # 6. Insert medical info (allergies, conditions, medications)
-        for allergy in data.allergies:
-            supabase_admin.table("medical_info").insert({
-                "elderly_id": user.id,
-                "info_type": "allergy",
-                "name": allergy,
-                "added_by": user.id
-            }).execute()
-        
-        for condition in data.conditions:
-            supabase_admin.table("medical_info").insert({
-                "elderly_id": user.id,
-                "info_type": "condition",
-                "name": condition,
-                "added_by": user.id
-            }).execute()
-        
-        for medication in data.medications:
-            supabase_admin.table("medical_info").insert({
-                "elderly_id": user.id,
-                "info_type": "medication",
-                "name": medication,
-                "added_by": user.id
-            }).execute()
-        
-        created = user_result.data[0]
-        return UserProfile(
-            id=created["id"],
-            email=created["email"],
-            full_name=created["full_name"],
-            avatar_url=created.get("avatar_url"),
-            phone=created.get("phone"),
-            role=created["role"]
+        for info_type, names in (
+            ("allergy", data.allergies),
+            ("condition", data.conditions),
+            ("medication", data.medications),
         )
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
+        for name in names
+    ]
+    
+    # Insert everything in one transaction (see supabase/migrations)
+    return await _register(
+        supabase_admin.rpc("create_caregiver", {
+            "_user": new_user,
+            "_elderly": elderly_profile,
+            "_medical": medical_rows
+        }).select(USER_PROFILE_COLUMNS)
+    )
@@ -0,0 +1,58 @@
+-- Registration functions called by the API (api/index.py).
+-- Each one creates the 'users' row and its role-specific rows in a single
+-- transaction, so a failed insert never leaves a half-registered user behind.
+-- A duplicate registration fails with unique_violation (23505).
+
+create or replace function public.create_professional(_user jsonb, _prof jsonb)
+returns public.users
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  created public.users;
+begin
+  insert into public.users (id, email, full_name, avatar_url, phone, role)
+  select id, email, full_name, avatar_url, phone, role
+  from jsonb_populate_record(null::public.users, _user)
+  returning * into created;
+
+  insert into public.professional_profiles (user_id, professional_email, specialization, workplace)
+  select user_id, professional_email, specialization, workplace
+  from jsonb_populate_record(null::public.professional_profiles, _prof);
+
+  return created;
+end;
+$$;
+
+create or replace function public.create_caregiver(_user jsonb, _elderly jsonb, _medical jsonb)
+returns public.users
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  created public.users;
+begin
+  insert into public.users (id, email, full_name, avatar_url, phone, role, emergency_contact)
+  select id, email, full_name, avatar_url, phone, role, emergency_contact
+  from jsonb_populate_record(null::public.users, _user)
+  returning * into created;
+
+  insert into public.elderly_profiles (user_id, date_of_birth, gender, height_cm, weight_kg, home_address)
+  select user_id, date_of_birth, gender, height_cm, weight_kg, home_address
+  from jsonb_populate_record(null::public.elderly_profiles, _elderly);
+
+  insert into public.medical_info (elderly_id, info_type, name, added_by)
+  select elderly_id, info_type, name, added_by
+  from jsonb_populate_recordset(null::public.medical_info, _medical);
+
+  return created;
+end;
+$$;
+
+-- Only the API's service role may call these
+revoke execute on function public.create_professional(jsonb, jsonb) from public, anon, authenticated;
+revoke execute on function public.create_caregiver(jsonb, jsonb, jsonb) from public, anon, authenticated;
+grant execute on function public.create_professional(jsonb, jsonb) to service_role;
+grant execute on function public.create_caregiver(jsonb, jsonb, jsonb) to service_role;